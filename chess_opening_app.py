@@ -2,11 +2,27 @@ import streamlit as st
 import chess
 import chess.svg
 import re
+import base64
 import time
 import random
 import json
+import logging
+import os
+import tempfile
+import threading
 from pathlib import Path
 from datetime import datetime, timedelta
+from types import MappingProxyType
+
+try:
+    import orjson  # Optional: faster progress serialization
+except ImportError:
+    orjson = None
+
+try:
+    import cairosvg  # Optional: pre-rasterized boards are cheaper for slow browsers
+except (ImportError, OSError):  # OSError: installed, but the cairo library is missing
+    cairosvg = None
 
 # Page configuration
 st.set_page_config(
@@ -15,145 +31,327 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+logger = logging.getLogger(__name__)
+
 # Progress tracking file
 PROGRESS_FILE = Path.home() / ".chess_opening_progress.json"
 
+@st.cache_resource
+def progress_lock():
+    """Lock shared by every session's script thread for the progress dict and file"""
+    return threading.Lock()
+
 def load_progress():
     """Load progress data from file"""
     if PROGRESS_FILE.exists():
         try:
-            with open(PROGRESS_FILE, 'r') as f:
-                return json.load(f)
-        except:
+            if orjson is not None:
+                progress = orjson.loads(PROGRESS_FILE.read_bytes())
+            else:
+                with open(PROGRESS_FILE, 'r') as f:
+                    progress = json.load(f)
+        except (ValueError, OSError) as e:  # JSONDecodeError (json and orjson) is a ValueError
+            logger.warning("Could not read %s, starting with empty progress: %s", PROGRESS_FILE, e)
             return {}
+        # Parse review timestamps once; '_' fields live in memory only
+        for status in progress.values():
+            for field in ('last_reviewed', 'last_graded'):
+                value = status.get(field)
+                status[f'_{field}_dt'] = datetime.fromisoformat(value) if value else None
+        return progress
     return {}
 
 def save_progress(progress):
     """Save progress data to file"""
-    with open(PROGRESS_FILE, 'w') as f:
-        json.dump(progress, f, indent=2)
+    with progress_lock():
+        persisted = {name: {k: v for k, v in status.items() if not k.startswith('_')}
+                     for name, status in progress.items()}
+        # Write a uniquely named temp file and swap it in, so a crash mid-write
+        # can't truncate the saved progress. The large buffer turns json.dump's
+        # streamed chunks into one write.
+        with tempfile.NamedTemporaryFile('wb' if orjson is not None else 'w', buffering=64 * 1024,
+                                         dir=PROGRESS_FILE.parent, prefix=PROGRESS_FILE.name + '.',
+                                         suffix='.tmp', delete=False) as f:
+            # Compact output: the file is only ever read back by this app
+            if orjson is not None:
+                f.write(orjson.dumps(persisted))
+            else:
+                json.dump(persisted, f, separators=(',', ':'))
+        os.replace(f.name, PROGRESS_FILE)
+
+def flush_progress(progress):
+    """Save progress once if anything changed it since the last save"""
+    if st.session_state.get('_progress_dirty'):
+        save_progress(progress)
+        st.session_state._progress_dirty = False
+
+# Status of an opening that has never been opened (read-only; copied on insert)
+DEFAULT_STATUS = MappingProxyType({
+    'mastered': False,
+    'last_reviewed': None,
+    'review_count': 0,
+    'ease': 2.5,  # SM-2 ease factor
+    'interval': 0,  # Days until the next review is due
+    'reps': 0,  # Passing quizzes in a row
+    'last_graded': None,  # When the interval was last set; the next review is due from here
+    '_last_reviewed_dt': None,
+    '_last_graded_dt': None
+})
+
+def init_progress(progress, openings):
+    """Add a default status for every opening, filling in fields older saves lack"""
+    for opening_name in openings:
+        progress[opening_name] = {**DEFAULT_STATUS, **progress.get(opening_name, {})}
 
 def get_opening_status(opening_name, progress):
-    """Get the status of an opening"""
-    if opening_name not in progress:
-        progress[opening_name] = {
-            'mastered': False,
-            'last_reviewed': None,
-            'review_count': 0
-        }
-    return progress[opening_name]
+    """Get the status of an opening (never modifies progress)"""
+    return progress.get(opening_name, DEFAULT_STATUS)
 
 def update_review(opening_name, progress):
     """Update review timestamp"""
-    status = get_opening_status(opening_name, progress)
-    status['last_reviewed'] = datetime.now().isoformat()
-    status['review_count'] += 1
-    save_progress(progress)
+    reviewed = datetime.now()
+    with progress_lock():
+        status = progress[opening_name]
+        status['last_reviewed'] = reviewed.isoformat()
+        status['_last_reviewed_dt'] = reviewed
+        status['review_count'] += 1
+    st.session_state._progress_dirty = True
 
 def toggle_mastered(opening_name, progress):
     """Toggle mastered status"""
-    status = get_opening_status(opening_name, progress)
-    status['mastered'] = not status['mastered']
-    save_progress(progress)
+    with progress_lock():
+        status = progress[opening_name]
+        status['mastered'] = not status['mastered']
+    st.session_state._progress_dirty = True
+
+def update_sm2(opening_name, progress, quality):
+    """Reschedule an opening from a 0-5 quiz grade (SM-2)"""
+    graded = datetime.now()
+    with progress_lock():
+        status = progress[opening_name]
+        status['last_graded'] = graded.isoformat()
+        status['_last_graded_dt'] = graded
+        if quality >= 3:
+            if status['reps'] == 0:
+                status['interval'] = 1
+            elif status['reps'] == 1:
+                status['interval'] = 6
+            else:
+                status['interval'] = round(status['interval'] * status['ease'])
+            status['reps'] += 1
+        else:
+            # Failed: start the sequence again, but keep the (lowered) ease
+            status['reps'] = 0
+            status['interval'] = 1
+        status['ease'] = max(1.3, status['ease'] + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    st.session_state._progress_dirty = True
 
-def should_review(opening_name, progress):
+def should_review(opening_name, progress, now=None):
     """Check if opening should be reviewed (spaced repetition)"""
     status = get_opening_status(opening_name, progress)
     if status['mastered']:
         return False
-    if status['last_reviewed'] is None:
+    # Only quiz grades move the due date; visits without a grade don't postpone it
+    last_graded = status['_last_graded_dt']
+    if last_graded is None:
         return True
+    return (now or datetime.now()) >= last_graded + timedelta(days=status['interval'])
+
+# A PNG blurs when stretched, so PNG boards are shown at a fixed width (and
+# rasterized at twice that for high-DPI screens); SVG boards fill the column
+BOARD_SIZE = 450
+BOARD_WIDTH = BOARD_SIZE if cairosvg is not None else "stretch"
+
+@st.cache_data(max_entries=512)
+def render_board(fen, size=BOARD_SIZE):
+    """Render a board as an image data URI, cached by FEN so shared positions render once"""
+    svg = chess.svg.board(chess.Board(fen), size=size)
+    # st.image passes data URIs through as is instead of re-encoding the image
+    if cairosvg is not None:
+        png = cairosvg.svg2png(bytestring=svg.encode(), output_width=2 * size)
+        return "data:image/png;base64," + base64.b64encode(png).decode()
+    return "data:image/svg+xml;base64," + base64.b64encode(svg.encode()).decode()
+
+# "Move 7. ...", "Move 4...Bf5: ...", "Move 5-6: ..." or "Moves 1-3: ..."
+IDEA_MOVES = re.compile(r'Moves? (\d+)(?:-(\d+))?[.:]')
+
+def group_key_ideas(key_ideas):
+    """Map each move number to the key ideas that start with "Move N" or "Moves N-M" """
+    by_move = {}
+    for idea in key_ideas:
+        match = IDEA_MOVES.match(idea)
+        if match:
+            first = int(match.group(1))
+            last = int(match.group(2) or first)
+            for move in range(first, last + 1):
+                by_move.setdefault(move, []).append(idea)
+    return by_move
+
+def parse_moves(moves_str):
+    """Split a numbered move string into SAN moves"""
+    # Move numbers are glued to the move ("1.d4"), so keep what follows the last dot
+    moves = [t.rpartition('.')[2] for t in moves_str.split()]
+    return [m for m in moves if m]
+
+@st.cache_data(max_entries=32)
+def precompute_opening(moves):
+    """Replay an opening's SAN moves once and return the FEN after every move"""
+    board = chess.Board()
+    fens = []
+    for san in moves:
+        board.push_san(san)
+        fens.append(board.fen())
+    return fens
+
+def _go_to(idx):
+    """Move the study board to a move index"""
+    st.session_state.move_idx = idx
+    st.session_state.auto_play = False  # Pause auto-play on manual navigation
+
+def _on_slide():
+    _go_to(st.session_state.move_idx)
+
+def _toggle_auto_play():
+    st.session_state.auto_play = not st.session_state.auto_play
+
+def _navigate(last_idx):
+    """Apply the clicked navigation arrow to the study board"""
+    choice = st.session_state.nav
+    st.session_state.nav = None  # Clear it so the same arrow can be clicked again
+    if choice == "⏮️":
+        _go_to(0)
+    elif choice == "◀️":
+        _go_to(max(st.session_state.move_idx - 1, 0))
+    elif choice == "▶️":
+        _go_to(min(st.session_state.move_idx + 1, last_idx))
+    elif choice == "⏭️":
+        _go_to(last_idx)
+
+@st.fragment
+def study_board(moves, fens):
+    """Study-mode board and navigation; reruns on its own without the rest of the page"""
+    last_idx = len(moves) - 1
+    # The slider owns move_idx, so auto-play steps it here, before the slider is drawn
+    if st.session_state.pop('auto_advance', False) and st.session_state.auto_play:
+        st.session_state.move_idx = min(st.session_state.move_idx + 1, last_idx)
+    st.markdown(f"**Move {st.session_state.move_idx + 1}/{len(moves)}**")
+
+    # Navigation (the callback updates move_idx before this fragment reruns)
+    st.segmented_control("Navigate", ["⏮️", "◀️", "▶️", "⏭️"], key="nav", on_change=_navigate,
+                         args=(last_idx,), label_visibility="collapsed")
+
+    st.slider("Jump", 0, last_idx, key="move_idx", on_change=_on_slide, label_visibility="collapsed")
+
+    # Board
+    st.image(render_board(fens[st.session_state.move_idx]), width=BOARD_WIDTH)
+    st.caption(f"Moves: {' '.join(moves[:st.session_state.move_idx + 1])}")
+
+    # Auto-play (the callbacks flip auto_play, so a click only reruns this fragment)
+    c1, c2 = st.columns([1, 3])
+    with c1:
+        if st.session_state.auto_play:
+            st.button("⏸️ Pause", on_click=_toggle_auto_play, use_container_width=True)
+        else:
+            st.button("▶️ Auto", on_click=_toggle_auto_play, use_container_width=True)
+    with c2:
+        speed = st.select_slider("Speed", [0.5, 1.0, 1.5, 2.0, 3.0], 1.5,
+                                format_func=lambda x: f"{x}s", label_visibility="collapsed")
 
-    last_review = datetime.fromisoformat(status['last_reviewed'])
-    review_count = status['review_count']
-
-    # Spaced repetition intervals: 1 day, 3 days, 7 days, 14 days, 30 days
-    intervals = [1, 3, 7, 14, 30]
-    interval_index = min(review_count, len(intervals) - 1)
-    next_review = last_review + timedelta(days=intervals[interval_index])
-
-    return datetime.now() >= next_review
-
-# Opening repertoire data
-OPENINGS = {
-    "White - Catalan Closed": {
-        "moves": "1.d4 d5 2.c4 e6 3.Nf3 Nf6 4.g3 Be7 5.Bg2 O-O 6.O-O Nbd7 7.Qc2 c6 8.Nbd2 b6 9.e4 Bb7 10.e5 Ne8 11.cxd5 cxd5 12.Nb3 Rc8 13.Qe2 Nc7 14.Bf4 Ba6 15.Qe3",
-        "key_ideas": [
-            "Move 7. Qc2: Queen supports e4 advance and eyes h7",
-            "Move 9. e4: THE key plan! Get space in center",
-            "Move 11. cxd5: Open lines for pieces, Bg2 becomes powerful",
-            "Move 14. Bf4: Develop with tempo, control central squares"
-        ],
-        "plan": "Control center with d4-e5 pawns. Bg2 pressures queenside. Look for tactics on d5. Improve pieces (Rooks to c1/e1)."
-    },
-    "White - Catalan Open": {
-        "moves": "1.d4 d5 2.c4 e6 3.Nf3 Nf6 4.g3 dxc4 5.Bg2 a6 6.O-O Nc6 7.e3 Bd6 8.Qe2 b5 9.a4 Rb8 10.Nbd2 O-O 11.Nxc4 Bb7 12.Nxd6 Qxd6 13.Bd2 Rfd8 14.Rfc1 Ne7 15.Bc3",
-        "key_ideas": [
-            "Move 5-6: Black takes c4 pawn - don't panic! Better development compensates",
-            "Move 7. e3: Flexible, supports center and prepares Qe2",
-            "Move 9. a4: CRITICAL! Stop Black's ...b4 expansion",
-            "Move 11. Nxc4: Finally win pawn back, trade Black's good bishop"
-        ],
-        "plan": "Better piece coordination. Control c-file. Look for d5 breakthrough. Bg2 aims at Black's king."
-    },
-    "White - Italian Game": {
-        "moves": "1.e4 e5 2.Nf3 Nc6 3.Bc4 Bc5 4.c3 Nf6 5.d4 exd4 6.cxd4 Bb4+ 7.Bd2 Bxd2+ 8.Nbxd2 d5 9.exd5 Nxd5 10.Qb3 Nce7 11.O-O O-O 12.Rfe1 c6 13.a4",
-        "key_ideas": [
-            "Move 4. c3: Prepares d4 break - THE key move",
-            "Move 5. d4: Central break when better developed",
-            "Move 6. cxd4: Recapture toward center, strong d4 pawn",
-            "Move 8. Nbxd2: Knight supports center, can jump to f3/e4",
-            "Move 10. Qb3: Attacks d5 and b7 simultaneously"
-        ],
-        "plan": "Small advantage from isolated d4 pawn. Activate rooks on e-file and c-file. Create threats before Black stabilizes."
-    },
-    "Black - Caro-Kann Classical": {
-        "moves": "1.e4 c6 2.d4 d5 3.Nc3 dxe4 4.Nxe4 Bf5 5.Ng3 Bg6 6.h4 h6 7.Nf3 Nd7 8.h5 Bh7 9.Bd3 Bxd3 10.Qxd3 e6 11.Bd2 Ngf6 12.O-O-O Be7 13.Ne4 Nxe4 14.Qxe4 Nf6 15.Qe2 O-O",
-        "key_ideas": [
-            "Move 1...c6: Supports d5, keeps bishop diagonal open",
-            "Move 3...dxe4: Trade center pawns for solid structure",
-            "Move 4...Bf5: KEY MOVE! Bishop out BEFORE ...e6",
-            "Move 6...h6: Stop White's h5 push",
-            "Move 9...Bxd3: Trade dangerous dark-squared bishop"
-        ],
-        "plan": "Solid position with no weaknesses. Complete development (...Ngf6, ...Be7, ...O-O). Look for ...c5 break. Slightly cramped but very solid."
-    },
-    "Black - Caro-Kann Advance": {
-        "moves": "1.e4 c6 2.d4 d5 3.e5 Bf5 4.Nf3 e6 5.Be2 c5 6.Be3 Nc6 7.c3 Qb6 8.Qb3 c4 9.Qxb6 axb6 10.Nbd2 b5 11.O-O b4",
-        "key_ideas": [
-            "Move 3...Bf5: Same idea - bishop out early before ...e6",
-            "Move 5...c5: Attack center immediately! Undermine e5 and d4",
-            "Move 7...Qb6: Dual purpose - attacks b2 and pressures d4",
-            "Move 8...c4: Lock center, gives queenside space"
-        ],
-        "plan": "Minority attack on queenside with ...b5-b4. White has more space but position is solid. Develop ...Nd7, ...Ne7, ...Rc8. Eventually ...f6 to challenge e5."
-    },
-    "Black - QGD Orthodox": {
-        "moves": "1.d4 d5 2.c4 e6 3.Nc3 Nf6 4.Bg5 Be7 5.e3 O-O 6.Nf3 Nbd7 7.Rc1 c6 8.Bd3 dxc4 9.Bxc4 Nd5 10.Bxe7 Qxe7 11.O-O Nxc3 12.Rxc3 e5 13.dxe5 Nxe5 14.Nxe5 Qxe5",
-        "key_ideas": [
-            "Move 2...e6: QGD formation - solid center, protects d5",
-            "Move 4...Be7: Simple development",
-            "Move 7...c6: IMPORTANT! Supports d5, prepares minority attack ideas",
-            "Move 8...dxc4: Wait for Bd3, then trade it off",
-            "Move 9...Nd5: Jump to center, force trade of good bishop"
-        ],
-        "plan": "Solid symmetrical position. Trade pieces when behind in space. Develop light-squared bishop to b7/e6. Look for ...c5 break eventually."
-    },
-    "Black - King's Indian": {
-        "moves": "1.d4 Nf6 2.c4 g6 3.Nc3 Bg7 4.e4 d6 5.Nf3 O-O 6.Be2 e5 7.O-O Nc6 8.d5 Ne7 9.Ne1 Nd7 10.f3 f5 11.Be3 f4 12.Bf2 g5 13.Nd3 Ng6 14.c5",
-        "key_ideas": [
-            "Moves 1-3: King's Indian setup - fianchetto dark-squared bishop",
-            "Move 5...O-O: Castle quickly for safety",
-            "Move 6...e5: KEY MOVE! Play for kingside attack, not classical center",
-            "Move 9...Nd7: Maneuver knight to kingside (Nd7-f6-h5/g4)",
-            "Move 10...f5: ATTACK! This is KID spirit - play for checkmate"
-        ],
-        "plan": "SHARP! Both sides attack opposite flanks. Attack White's king with ...g5-g4, ...Ng6-f4/h5. It's a RACE to checkmate. Only play when feeling sharp!"
-    }
+    # One move per fragment rerun. Clicks can't interrupt a running script, so
+    # they are handled between moves rather than after the whole line.
+    if st.session_state.auto_play:
+        if st.session_state.move_idx < last_idx:
+            time.sleep(speed)
+            st.session_state.auto_advance = True
+        else:
+            st.session_state.auto_play = False
+        st.rerun(scope="fragment")
+
+# Training-page buttons shown on the home page: (label, mode, key suffix)
+TRAINING_MODES = [
+    ("📖 Study", '📖 Study', 's'),
+    ("🎯 Quiz", '🎯 Quiz', 'q'),
+    ("🎲 Test", '🎲 Random Test', 't'),
+]
+
+def button_keys(key_prefix):
+    """Widget keys for one card's Study/Quiz/Test buttons"""
+    return tuple(f"{key_prefix}_{suffix}" for _, _, suffix in TRAINING_MODES)
+
+def render_mode_buttons(opening, keys, inline=False):
+    """Render the Study/Quiz/Test buttons that open an opening's training page"""
+    # Inline buttons share a row; otherwise they stack in the current column
+    slots = st.columns(len(TRAINING_MODES)) if inline else [st] * len(TRAINING_MODES)
+    for slot, (label, mode, _), key in zip(slots, TRAINING_MODES, keys):
+        if slot.button(label, key=key, use_container_width=True):
+            st.session_state.page = 'training'
+            st.session_state.selected_opening = opening
+            st.session_state.mode = mode
+            st.rerun()
+
+def render_opening_card(opening, keys, status):
+    """Render a repertoire card: mastered check, review count and mode buttons"""
+    name = opening.replace('White - ', '').replace('Black - ', '')
+    check = "✅" if status['mastered'] else "⬜"
+
+    st.markdown(f"### {check} {name}")
+    st.caption(f"Reviewed {status['review_count']} times" if status['review_count'] > 0 else "Not started")
+
+    render_mode_buttons(opening, keys)
+
+# Opening repertoire data file (shipped next to the app)
+OPENINGS_FILE = Path(__file__).parent / "openings.json"
+
+@st.cache_resource
+def load_openings():
+    """Load the opening repertoire data once per process"""
+    if orjson is not None:
+        return orjson.loads(OPENINGS_FILE.read_bytes())
+    with open(OPENINGS_FILE, encoding='utf-8') as f:
+        return json.load(f)
+
+# Opening repertoire data (read-only; everything below derives from it)
+OPENINGS = MappingProxyType(load_openings())
+
+# Repertoire sections (OPENINGS is constant, so group once at import)
+_KEYS = tuple(OPENINGS)
+WHITE_OPENINGS = tuple(k for k in _KEYS if k.startswith("White"))
+BLACK_E4_OPENINGS = tuple(k for k in _KEYS if "Caro-Kann" in k)
+BLACK_D4_OPENINGS = tuple(k for k in _KEYS if k.startswith("Black") and "Caro-Kann" not in k)
+
+# Home-page button keys, built once: section -> [(opening, keys), ...]
+HOME_BUTTONS = {
+    'white': [(o, button_keys(f"w_{i}")) for i, o in enumerate(WHITE_OPENINGS)],
+    'e4': [(o, button_keys(f"e_{i}")) for i, o in enumerate(BLACK_E4_OPENINGS)],
+    'd4': [(o, button_keys(f"d_{i}")) for i, o in enumerate(BLACK_D4_OPENINGS)],
 }
+PRIORITY_BUTTON_KEYS = {o: button_keys(f"pr_{o}") for o in _KEYS}
+
+# Parsed move lists and key ideas (static, so parsed once at import)
+MOVES = MappingProxyType({name: tuple(parse_moves(data["moves"])) for name, data in OPENINGS.items()})
+KEY_IDEAS_BY_MOVE = MappingProxyType({name: group_key_ideas(data["key_ideas"]) for name, data in OPENINGS.items()})
 
-# Load progress
-progress = load_progress()
+@st.cache_resource
+def build_repertoire():
+    """Precompute the positions of every opening in a single pass"""
+    return {name: precompute_opening(moves) for name, moves in MOVES.items()}
+
+# Warm the cache up front so switching openings never replays moves
+repertoire = build_repertoire()
+
+@st.cache_resource
+def shared_progress():
+    """Load progress once per process; every session updates the same dict in place"""
+    progress = load_progress()
+    init_progress(progress, OPENINGS)
+    return progress
+
+# Reruns and other tabs reuse the in-memory copy; only saves touch the file
+progress = shared_progress()
+
+# Status and due flag for every opening, computed once per rerun
+now = datetime.now()
+review_state = {o: (get_opening_status(o, progress), should_review(o, progress, now)) for o in OPENINGS}
 
 # Initialize session state
 if 'page' not in st.session_state:
@@ -162,6 +360,13 @@ if 'selected_opening' not in st.session_state:
     st.session_state.selected_opening = None
 if 'mode' not in st.session_state:
     st.session_state.mode = '📖 Study'
+# move_idx is the study slider's key; re-assigning it keeps Streamlit from
+# dropping it on runs where the slider isn't drawn (Quiz, Random Test, Home)
+if 'move_idx' in st.session_state:
+    st.session_state.move_idx = st.session_state.move_idx
+# Auto-play only steps in fragment reruns (a fragment-scoped rerun is not
+# allowed in a full run), so anything that reruns the whole page pauses it
+st.session_state.auto_play = False
 
 # Sidebar
 with st.sidebar:
@@ -175,8 +380,8 @@ with st.sidebar:
 
     # Stats
     total = len(OPENINGS)
-    mastered = sum(1 for o in OPENINGS if get_opening_status(o, progress)['mastered'])
-    needs_review = sum(1 for o in OPENINGS if should_review(o, progress))
+    mastered = sum(1 for status, _ in review_state.values() if status['mastered'])
+    needs_review = sum(1 for _, due in review_state.values() if due)
 
     st.metric("Mastered", f"{mastered}/{total}")
     if needs_review > 0:
@@ -189,6 +394,7 @@ with st.sidebar:
 
 #  HOME PAGE
 if st.session_state.page == 'home':
+    st.session_state.reviewed_opening = None  # Coming home ends the current visit
     st.title("♟️ Chess Opening Memorization Trainer")
     st.markdown("### Master your repertoire through active practice")
 
@@ -212,36 +418,17 @@ if st.session_state.page == 'home':
 
         cols = st.columns(2)
         idx = 0
-        for opening in OPENINGS:
-            if should_review(opening, progress):
+        for opening, (status, due) in review_state.items():
+            if due:
                 with cols[idx % 2]:
-                    status = get_opening_status(opening, progress)
                     name = opening.replace('White - ', '').replace('Black - ', '')
                     st.markdown(f"### {name}")
 
-                    if status['last_reviewed']:
-                        days = (datetime.now() - datetime.fromisoformat(status['last_reviewed'])).days
+                    if status['_last_reviewed_dt']:
+                        days = (now - status['_last_reviewed_dt']).days
                         st.caption(f"Last reviewed {days} days ago")
 
-                    c1, c2, c3 = st.columns(3)
-                    with c1:
-                        if st.button("📖 Study", key=f"pr_s_{opening}", use_container_width=True):
-                            st.session_state.page = 'training'
-                            st.session_state.selected_opening = opening
-                            st.session_state.mode = '📖 Study'
-                            st.rerun()
-                    with c2:
-                        if st.button("🎯 Quiz", key=f"pr_q_{opening}", use_container_width=True):
-                            st.session_state.page = 'training'
-                            st.session_state.selected_opening = opening
-                            st.session_state.mode = '🎯 Quiz'
-                            st.rerun()
-                    with c3:
-                        if st.button("🎲 Test", key=f"pr_t_{opening}", use_container_width=True):
-                            st.session_state.page = 'training'
-                            st.session_state.selected_opening = opening
-                            st.session_state.mode = '🎲 Random Test'
-                            st.rerun()
+                    render_mode_buttons(opening, PRIORITY_BUTTON_KEYS[opening], inline=True)
                     st.markdown("---")
                 idx += 1
 
@@ -252,94 +439,28 @@ if st.session_state.page == 'home':
 
     # White
     st.markdown("### ⚪ As White")
-    white = [k for k in OPENINGS if k.startswith("White")]
-    cols = st.columns(len(white))
-    for i, opening in enumerate(white):
-        with cols[i]:
-            status = get_opening_status(opening, progress)
-            name = opening.replace('White - ', '')
-            check = "✅" if status['mastered'] else "⬜"
-
-            st.markdown(f"### {check} {name}")
-            st.caption(f"Reviewed {status['review_count']} times" if status['review_count'] > 0 else "Not started")
-
-            if st.button("📖 Study", key=f"w_s_{i}", use_container_width=True):
-                st.session_state.page = 'training'
-                st.session_state.selected_opening = opening
-                st.session_state.mode = '📖 Study'
-                st.rerun()
-            if st.button("🎯 Quiz", key=f"w_q_{i}", use_container_width=True):
-                st.session_state.page = 'training'
-                st.session_state.selected_opening = opening
-                st.session_state.mode = '🎯 Quiz'
-                st.rerun()
-            if st.button("🎲 Test", key=f"w_t_{i}", use_container_width=True):
-                st.session_state.page = 'training'
-                st.session_state.selected_opening = opening
-                st.session_state.mode = '🎲 Random Test'
-                st.rerun()
+    cols = st.columns(len(WHITE_OPENINGS))
+    for col, (opening, keys) in zip(cols, HOME_BUTTONS['white']):
+        with col:
+            render_opening_card(opening, keys, review_state[opening][0])
 
     st.markdown("---")
 
     # Black vs e4
     st.markdown("### ⚫ As Black vs 1.e4")
-    e4 = [k for k in OPENINGS if "Caro-Kann" in k]
-    cols = st.columns(len(e4))
-    for i, opening in enumerate(e4):
-        with cols[i]:
-            status = get_opening_status(opening, progress)
-            name = opening.replace('Black - ', '')
-            check = "✅" if status['mastered'] else "⬜"
-
-            st.markdown(f"### {check} {name}")
-            st.caption(f"Reviewed {status['review_count']} times" if status['review_count'] > 0 else "Not started")
-
-            if st.button("📖 Study", key=f"e_s_{i}", use_container_width=True):
-                st.session_state.page = 'training'
-                st.session_state.selected_opening = opening
-                st.session_state.mode = '📖 Study'
-                st.rerun()
-            if st.button("🎯 Quiz", key=f"e_q_{i}", use_container_width=True):
-                st.session_state.page = 'training'
-                st.session_state.selected_opening = opening
-                st.session_state.mode = '🎯 Quiz'
-                st.rerun()
-            if st.button("🎲 Test", key=f"e_t_{i}", use_container_width=True):
-                st.session_state.page = 'training'
-                st.session_state.selected_opening = opening
-                st.session_state.mode = '🎲 Random Test'
-                st.rerun()
+    cols = st.columns(len(BLACK_E4_OPENINGS))
+    for col, (opening, keys) in zip(cols, HOME_BUTTONS['e4']):
+        with col:
+            render_opening_card(opening, keys, review_state[opening][0])
 
     st.markdown("---")
 
     # Black vs d4
     st.markdown("### ⚫ As Black vs 1.d4")
-    d4 = [k for k in OPENINGS if k.startswith("Black") and "Caro-Kann" not in k]
-    cols = st.columns(len(d4))
-    for i, opening in enumerate(d4):
-        with cols[i]:
-            status = get_opening_status(opening, progress)
-            name = opening.replace('Black - ', '')
-            check = "✅" if status['mastered'] else "⬜"
-
-            st.markdown(f"### {check} {name}")
-            st.caption(f"Reviewed {status['review_count']} times" if status['review_count'] > 0 else "Not started")
-
-            if st.button("📖 Study", key=f"d_s_{i}", use_container_width=True):
-                st.session_state.page = 'training'
-                st.session_state.selected_opening = opening
-                st.session_state.mode = '📖 Study'
-                st.rerun()
-            if st.button("🎯 Quiz", key=f"d_q_{i}", use_container_width=True):
-                st.session_state.page = 'training'
-                st.session_state.selected_opening = opening
-                st.session_state.mode = '🎯 Quiz'
-                st.rerun()
-            if st.button("🎲 Test", key=f"d_t_{i}", use_container_width=True):
-                st.session_state.page = 'training'
-                st.session_state.selected_opening = opening
-                st.session_state.mode = '🎲 Random Test'
-                st.rerun()
+    cols = st.columns(len(BLACK_D4_OPENINGS))
+    for col, (opening, keys) in zip(cols, HOME_BUTTONS['d4']):
+        with col:
+            render_opening_card(opening, keys, review_state[opening][0])
 
     st.markdown("---")
 
@@ -360,7 +481,7 @@ elif st.session_state.page == 'training':
 
     opening = st.session_state.selected_opening
     data = OPENINGS[opening]
-    status = get_opening_status(opening, progress)
+    status = review_state[opening][0]
     mode = st.session_state.mode
 
     # Header
@@ -390,16 +511,28 @@ elif st.session_state.page == 'training':
 
     st.markdown("---")
 
-    # Update review
-    update_review(opening, progress)
-
-    # Parse moves
-    moves_str = re.sub(r'\d+\.', '', data["moves"])
-    moves = [m.strip() for m in moves_str.split() if m.strip()]
+    # Update review (once per visit, not on every rerun)
+    if st.session_state.get('reviewed_opening') != opening:
+        update_review(opening, progress)
+        st.session_state.reviewed_opening = opening
+        # This visit's quiz answers by move index (a reveal counts as a miss). The
+        # first pass that answers every move grades the opening; SM-2 takes one
+        # grade per review, so later passes in the same visit are practice only
+        st.session_state.quiz_answers = {}
+        st.session_state.quiz_graded = False
+        # Positions from the last opening may be past the end of this one
+        st.session_state.move_idx = 0
+        st.session_state.random_idx = None
+        st.session_state.show_answer = False
+        st.session_state.user_guess = ''
+
+    # Moves and positions are precomputed per opening
+    moves = MOVES[opening]
+    fens = repertoire[opening]
 
     # Initialize states
     for key, default in [
-        ('move_idx', 0), ('auto_play', False), ('quiz_correct', 0),
+        ('move_idx', 0), ('quiz_correct', 0),
         ('quiz_total', 0), ('show_answer', False), ('user_guess', ''),
         ('random_idx', None)
     ]:
@@ -416,12 +549,8 @@ elif st.session_state.page == 'training':
 
         if st.session_state.random_idx:
             idx = st.session_state.random_idx
-            board = chess.Board()
-            for m in moves[:idx]:
-                board.push_san(m)
-
             st.markdown(f"**Position after move {idx}. What's next?**")
-            st.image(chess.svg.board(board, size=450), use_container_width=True)
+            st.image(render_board(fens[idx - 1]), width=BOARD_WIDTH)
 
             c1, c2 = st.columns(2)
             with c1:
@@ -446,17 +575,21 @@ elif st.session_state.page == 'training':
 
         if st.session_state.move_idx >= len(moves) - 1:
             st.success("🎉 Completed!")
+            answers = st.session_state.quiz_answers
+            if not st.session_state.quiz_graded:
+                if len(answers) == len(moves) - 1:
+                    update_sm2(opening, progress, round(5 * sum(answers.values()) / len(answers)))
+                    st.session_state.quiz_graded = True
+                else:
+                    st.caption("Answer every move from the start to update the review schedule")
             if st.button("Restart"):
                 st.session_state.move_idx = 0
                 st.session_state.show_answer = False
+                st.session_state.quiz_answers = {}
                 st.rerun()
         else:
-            board = chess.Board()
-            for m in moves[:st.session_state.move_idx + 1]:
-                board.push_san(m)
-
             st.markdown(f"**Move {st.session_state.move_idx + 2}/{len(moves)}**")
-            st.image(chess.svg.board(board, size=450), use_container_width=True)
+            st.image(render_board(fens[st.session_state.move_idx]), width=BOARD_WIDTH)
             st.caption(f"Moves: {' '.join(moves[:st.session_state.move_idx + 1])}")
 
             if not st.session_state.show_answer:
@@ -469,11 +602,13 @@ elif st.session_state.page == 'training':
                         if guess.strip() == correct:
                             st.session_state.quiz_correct += 1
                         st.session_state.quiz_total += 1
+                        st.session_state.quiz_answers[st.session_state.move_idx] = guess.strip() == correct
                         st.session_state.user_guess = guess.strip()
                         st.session_state.show_answer = True
                         st.rerun()
                 with c3:
                     if st.button("💡 Reveal", use_container_width=True):
+                        st.session_state.quiz_answers[st.session_state.move_idx] = False
                         st.session_state.show_answer = True
                         st.rerun()
             else:
@@ -486,9 +621,8 @@ elif st.session_state.page == 'training':
                     st.info(f"Answer: {correct}")
 
                 # Show key idea
-                for idea in data["key_ideas"]:
-                    if f"Move {st.session_state.move_idx + 2}" in idea:
-                        st.markdown(f"💡 {idea}")
+                for idea in KEY_IDEAS_BY_MOVE[opening].get(st.session_state.move_idx + 2, ()):
+                    st.markdown(f"💡 {idea}")
 
                 if st.button("➡️ Next"):
                     st.session_state.move_idx += 1
@@ -500,63 +634,7 @@ elif st.session_state.page == 'training':
 
     else:  # Study mode
         st.markdown("### 📖 Study Mode")
-        st.markdown(f"**Move {st.session_state.move_idx + 1}/{len(moves)}**")
-
-        # Navigation
-        cols = st.columns([1,1,1,1,1,1,1,1], gap="small")
-        if cols[0].button("⏮️", key="start", use_container_width=True):
-            st.session_state.move_idx = 0
-            st.session_state.auto_play = False  # Pause auto-play on manual navigation
-            st.rerun()
-        if cols[2].button("◀️", key="prev", use_container_width=True):
-            if st.session_state.move_idx > 0:
-                st.session_state.move_idx -= 1
-                st.session_state.auto_play = False  # Pause auto-play on manual navigation
-                st.rerun()
-        if cols[4].button("▶️", key="next", use_container_width=True):
-            if st.session_state.move_idx < len(moves) - 1:
-                st.session_state.move_idx += 1
-                st.session_state.auto_play = False  # Pause auto-play on manual navigation
-                st.rerun()
-        if cols[6].button("⏭️", key="end", use_container_width=True):
-            st.session_state.move_idx = len(moves) - 1
-            st.session_state.auto_play = False  # Pause auto-play on manual navigation
-            st.rerun()
-
-        new_idx = st.slider("Jump", 0, len(moves)-1, st.session_state.move_idx, label_visibility="collapsed")
-        if new_idx != st.session_state.move_idx:
-            st.session_state.move_idx = new_idx
-            st.session_state.auto_play = False  # Pause auto-play on manual navigation
-
-        # Board
-        board = chess.Board()
-        for m in moves[:st.session_state.move_idx + 1]:
-            board.push_san(m)
-
-        st.image(chess.svg.board(board, size=450), use_container_width=True)
-        st.caption(f"Moves: {' '.join(moves[:st.session_state.move_idx + 1])}")
-
-        # Auto-play
-        c1, c2 = st.columns([1, 3])
-        with c1:
-            if st.session_state.auto_play:
-                if st.button("⏸️ Pause", use_container_width=True):
-                    st.session_state.auto_play = False
-                    st.rerun()
-            else:
-                if st.button("▶️ Auto", use_container_width=True):
-                    st.session_state.auto_play = True
-                    st.rerun()
-        with c2:
-            speed = st.select_slider("Speed", [0.5, 1.0, 1.5, 2.0, 3.0], 1.5,
-                                    format_func=lambda x: f"{x}s", label_visibility="collapsed")
-
-        if st.session_state.auto_play and st.session_state.move_idx < len(moves) - 1:
-            time.sleep(speed)
-            st.session_state.move_idx += 1
-            st.rerun()
-        elif st.session_state.auto_play:
-            st.session_state.auto_play = False
+        study_board(moves, fens)
 
         # Info
         st.markdown("---")
@@ -571,3 +649,7 @@ elif st.session_state.page == 'training':
 # Footer
 st.markdown("---")
 st.caption("**Active practice beats passive study** • Quiz yourself • Track progress")
+
+# Write progress at most once per run. Runs cut short by st.rerun() leave the
+# dirty flag set, so the next full run writes it.
+flush_progress(progress)